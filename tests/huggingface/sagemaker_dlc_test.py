@@ -2,23 +2,134 @@ import logging
 import sys
 import argparse
 import time
-import signal
-import json
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
-from sagemaker.huggingface import HuggingFaceModel
+# The AWS and SageMaker SDKs are imported where they are used: they take seconds
+# to import, and pytest imports this module when collecting *_test.py files.
 
+# SageMaker endpoint names allow only alphanumerics and hyphens, up to 63 characters
+ENDPOINT_NAME_TABLE = str.maketrans({"/": "-", ".": "-", "_": "-"})
+MAX_MODEL_NAME_LENGTH = 40
+# Run timestamp plus a counter keeps names unique when run_test is called
+# concurrently within the same second
+RUN_ID = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+ENDPOINT_COUNTER = itertools.count()
+# Model.deploy() checks the endpoint every 30 seconds, which adds up to that
+# much idle time once a small model is already in service
+ENDPOINT_POLL_INTERVAL = 10
+ENDPOINT_IN_PROGRESS_STATUSES = ("Creating", "Updating", "SystemUpdating", "RollingBack")
+# Upper bound on waiting for an endpoint to reach a final state before cleanup
+ENDPOINT_SETTLE_TIMEOUT = 3600
+# Sanity request sent to the deployed endpoint
+DATA = {"inputs": "What is Deep Learning?"}
 
-class TimeoutError(Exception):
-    pass
 
+def create_session(region):
+    import boto3
+    from botocore.config import Config
+    from sagemaker import Session
 
-def timeout_handler(signum, frame):
-    raise TimeoutError("Test timed out")
+    # Client-side limits so a stalled SageMaker API call cannot hang the test
+    client_config = Config(connect_timeout=60, read_timeout=120, retries={'max_attempts': 3})
+    boto_session = boto3.Session(region_name=region)
+    return Session(
+        boto_session=boto_session,
+        sagemaker_client=boto_session.client("sagemaker", config=client_config),
+        sagemaker_runtime_client=boto_session.client("sagemaker-runtime", config=client_config)
+    )
+
+
+def is_endpoint_not_found(error):
+    error = error.response["Error"]
+    return error["Code"] == "ValidationException" and "Could not find endpoint" in error["Message"]
+
+
+def poll_endpoint(session, endpoint_name, deadline, cancel):
+    from botocore.exceptions import ClientError
+
+    # Describe the endpoint every ENDPOINT_POLL_INTERVAL seconds until it leaves
+    # the in-progress states, returning the last description (None if it does
+    # not exist). Returns early, still in progress, once cancel is set.
+    while True:
+        try:
+            desc = session.sagemaker_client.describe_endpoint(EndpointName=endpoint_name)
+        except ClientError as e:
+            if is_endpoint_not_found(e):
+                return None
+            raise
+        status = desc["EndpointStatus"]
+        if status not in ENDPOINT_IN_PROGRESS_STATUSES or cancel.is_set():
+            return desc
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Endpoint {} still {} at the deadline".format(endpoint_name, status))
+        cancel.wait(min(ENDPOINT_POLL_INTERVAL, remaining))
+
+
+def wait_for_endpoint(session, endpoint_name, cancel, deadline):
+    from sagemaker.exceptions import UnexpectedStatusException
+
+    # Unlike Session.wait_for_endpoint, stop polling once the test is cancelled
+    # or its deadline passes, so a timed-out run does not wait for InService.
+    desc = poll_endpoint(session, endpoint_name, deadline, cancel)
+    if cancel.is_set():
+        return
+    status = desc["EndpointStatus"] if desc is not None else None
+    if status != "InService":
+        reason = desc.get("FailureReason", "(No reason provided)") if desc is not None else "Endpoint not found"
+        message = "Error hosting endpoint {}: {}. Reason: {}.".format(endpoint_name, status, reason)
+        raise UnexpectedStatusException(message=message, allowed_statuses=["InService"], actual_status=status)
+
+
+def deploy_and_predict(model, args, endpoint_name, cancel):
+    deadline = time.monotonic() + int(args.timeout)
+    predictor = model.deploy(instance_type=args.instance_type,
+                             initial_instance_count=1,
+                             endpoint_name=endpoint_name,
+                             wait=False)
+    wait_for_endpoint(model.sagemaker_session, endpoint_name, cancel, deadline)
+    if cancel.is_set():
+        return
+    logging.info("Endpoint deployment complete.")
+
+    output = predictor.predict(DATA)
+    logging.info("Output: %s", output)
+    assert "generated_text" in output[0]
+
+
+def wait_for_endpoint_to_settle(session, endpoint_name):
+    # SageMaker may reject deleting an endpoint that is still being created or
+    # updated, so wait until it reaches a final state (or does not exist).
+    logging.info("Waiting for endpoint %s to reach a final state before cleanup", endpoint_name)
+    poll_endpoint(session, endpoint_name, time.monotonic() + ENDPOINT_SETTLE_TIMEOUT, threading.Event())
+
+
+def delete_resources(session, endpoint_name):
+    from botocore.exceptions import ClientError
+
+    try:
+        wait_for_endpoint_to_settle(session, endpoint_name)
+    except (ClientError, TimeoutError) as e:
+        # Still try the deletes below; a rejected endpoint delete is logged
+        logging.error("Endpoint %s did not reach a final state and may need to be deleted manually: %s",
+                      endpoint_name, e)
+    # The endpoint, its config and the model all share the endpoint name. Any of
+    # them may be missing if the test failed or timed out before creating it.
+    for delete in (session.delete_endpoint, session.delete_endpoint_config, session.delete_model):
+        try:
+            delete(endpoint_name)
+        except ClientError as e:
+            logging.warning("Cleanup of %s failed: %s", endpoint_name, e)
 
 
 # Running test
 def run_test(args):
-    endpoint_name = args.model_id.replace("/","-") + "-" + time.strftime("%Y-%m-%d-%H-%M-%S", time.gmtime())
+    from sagemaker.huggingface import HuggingFaceModel
+
+    endpoint_name = "{}-{}-{:03d}".format(args.model_id.translate(ENDPOINT_NAME_TABLE)[:MAX_MODEL_NAME_LENGTH],
+                                          RUN_ID, next(ENDPOINT_COUNTER))
 
     hub = {
         'HF_MODEL_ID':args.model_id,
@@ -26,8 +137,11 @@ def run_test(args):
         'SM_NUM_GPUS':args.num_gpus
     }
 
-    signal.signal(signal.SIGALRM, timeout_handler)
-    signal.alarm(int(args.timeout))
+    session = create_session(args.region)
+    # Run the test on a worker thread so the timeout does not rely on SIGALRM,
+    # which only works on the main thread.
+    executor = ThreadPoolExecutor(max_workers=1)
+    cancel = threading.Event()
 
     try:
         # Create Hugging Face Model Class
@@ -35,23 +149,21 @@ def run_test(args):
             name=endpoint_name,
             env=hub,
             role=args.role,
-            image_uri=args.image_uri
+            image_uri=args.image_uri,
+            sagemaker_session=session
         )
-        predictor = model.deploy(instance_type=args.instance_type,
-                                 initial_instance_count=1,
-                                 endpoint_name=endpoint_name)
-        logging.info("Endpoint deployment complete.")
-
-        data = {"inputs": "What is Deep Learning?"}
-        output = predictor.predict(data)
-        logging.info("Output: " + json.dumps(output))
-        assert "generated_text" in output[0]
+        executor.submit(deploy_and_predict, model, args, endpoint_name, cancel).result(timeout=int(args.timeout))
     except TimeoutError:
-        logging.error("Test timed out after {} seconds".format(args.timeout))
+        logging.error("Test timed out after %s seconds", args.timeout)
+        # Fail the run once the finally block has cleaned up
+        raise
     finally:
-        predictor.delete_model()
-        predictor.delete_endpoint()
-        signal.alarm(0)
+        # Stop the worker however we got here (timeout, Ctrl-C, ...), then let
+        # it finish its last SageMaker call so cleanup runs after every create
+        # call has been issued
+        cancel.set()
+        executor.shutdown(wait=True)
+        delete_resources(session, endpoint_name)
 
 
 if __name__ == '__main__':